@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from typing import Union
 
 
 class GraphAttentionV2Layer(nn.Module):
@@ -9,13 +10,14 @@ class GraphAttentionV2Layer(nn.Module):
                  dropout: float = 0.25,
                  leaky_relu_negative_slope: float = 0.21,
                  share_weights: bool = False,
-                 mask: int = -6e4):
+                 mask: Union[float, torch.Tensor] = -6e4):
         super().__init__()
 
         self.is_concat = is_concat
         self.n_heads = n_heads
         self.share_weights = share_weights
-        self.mask = mask
+        # 0 维张量作为 buffer 随模型移动设备；torch.where 直接在设备上取值，不会像 masked_fill 那样把张量值读回主机
+        self.register_buffer("mask", torch.as_tensor(mask).clone(), persistent=False)
         # Calculate the number of dimensions per head
         if is_concat:
             assert out_features % n_heads == 0
@@ -56,7 +58,7 @@ class GraphAttentionV2Layer(nn.Module):
         assert adj_mat.shape[1] == 1 or adj_mat.shape[1] == n_nodes
         assert adj_mat.shape[2] == 1 or adj_mat.shape[2] == n_nodes
         assert adj_mat.shape[3] == 1 or adj_mat.shape[3] == self.n_heads
-        e = e.masked_fill(adj_mat == 0, self.mask)
+        e = torch.where(adj_mat == 0, self.mask.to(e.dtype), e)
         a = self.softmax(e)
         a = self.dropout(a)
         attn_res = torch.einsum('bijh,bjhf->bihf', a, g_r)
@@ -28,9 +28,9 @@ class KnowledgeSelector(nn.Module):
     def forward(self, batch_input, agent_state, current_score, label_smoothing_rate):
         gold, nodes = batch_input
         self.label_smoothing_rate = label_smoothing_rate
-        knowledge_pool, knowledge_nll, raw_kp, mean_k = self.knowledge_selection(gold, nodes, agent_state, current_score)
+        knowledge_pool, pool_length, knowledge_nll, raw_kp, mean_k = self.knowledge_selection(gold, nodes, agent_state, current_score)
 
-        return knowledge_pool, knowledge_nll, raw_kp, mean_k
+        return knowledge_pool, pool_length, knowledge_nll, raw_kp, mean_k
 
     def knowledge_pad(self, inp, value=0):
         if inp.shape[1] < self.base_poolsize:
@@ -54,7 +54,7 @@ class KnowledgeSelector(nn.Module):
         return result, score
 
     def knowledge_selection(self, gold, nodes, agent_state: torch.Tensor,
-                            score_distribution: torch.Tensor) -> tuple[list[Any], Tensor, list[Any], Tensor]:
+                            score_distribution: torch.Tensor) -> tuple[list[Any], Tensor, Tensor, list[Any], Tensor]:
         batch_size = len(score_distribution)
 
         indices = [i.nonzero(as_tuple=True)[0] for i in score_distribution]
@@ -94,8 +94,7 @@ class KnowledgeSelector(nn.Module):
                 diff = len(sample_knowledge[-1]) - (sample_size - self.base_poolsize)
                 sample_knowledge[-1] = sample_knowledge[-1][0:diff]
 
-            sample_embedding = self.environment.get_knowledge_embedding(sample_nodes)
-            sample_embedding = torch.cat([d["embedding"] for d in sample_embedding])[0:self.base_poolsize]
+            sample_embedding = self.environment.get_knowledge_embedding(sample_nodes)[0:self.base_poolsize]
 
             raw_size = torch.as_tensor([len(n) for n in sample_knowledge], device=self.device)
             att = sample_score.repeat_interleave(raw_size)
@@ -128,4 +127,5 @@ class KnowledgeSelector(nn.Module):
         label = smooth_labels(label, smoothing_rate=self.label_smoothing_rate)
         nll = torch.sum(bi_tempered_logistic_loss(activations=activations, labels=label, t1=0.8, t2=1.2))
 
-        return pool, nll, raw_pool, mean_k
\ No newline at end of file
+        # k 即每个样本知识池的实际大小 [batch_size]
+        return pool, k, nll, raw_pool, mean_k
\ No newline at end of file
@@ -4,7 +4,6 @@ import torch.nn.functional as F
 from KnowledgeSelection.Model.module import ModalityAttentionLayer
 from KnowledgeSelection.Model.model_utils import smooth_labels, bi_tempered_logistic_loss
 import numpy as np
-from typing import List
 
 
 class NodeSelector(nn.Module):
@@ -20,13 +19,13 @@ class NodeSelector(nn.Module):
 
     def forward(self, batch_input, all_node_embedding, input_info, agent_state, current_input, train, label_smoothing_rate):
         nodes, adj, label = batch_input
-        current_node, current_activation, current_score = current_input
+        current_idx, current_score = current_input
         self.label_smoothing_rate = label_smoothing_rate
-        agent_state, current_node, current_activation, current_score, prob, node_nll = \
+        agent_state, current_node, current_idx, current_score, prob, node_nll = \
         self.walk_step(nodes, adj, label, all_node_embedding, input_info, agent_state,
-                       current_node, current_activation, current_score, train)
+                       current_idx, current_score, train)
 
-        return agent_state, current_node, current_activation, current_score, prob, node_nll
+        return agent_state, current_node, current_idx, current_score, prob, node_nll
 
     # @profile
     def node_score(self, all_node_embedding: torch.Tensor, state: torch.Tensor, node_idx: torch.Tensor, nodes: np.ndarray,
@@ -50,6 +49,8 @@ class NodeSelector(nn.Module):
             # 新的embedding矩阵
             step_embedding.append(embedding[indices].squeeze())
         step_embedding = nn.utils.rnn.pad_sequence(step_embedding, batch_first=True)
+        # 补齐到 8 的倍数，填充位置由 step_adj 与 step_mask 屏蔽
+        step_embedding = F.pad(step_embedding, (0, 0, 0, -step_embedding.shape[1] % 8))
         # 与state拼接
         step_embedding = torch.cat([step_embedding, state.unsqueeze(1).expand(-1, step_embedding.shape[1], -1)], dim=2)
         max_n = step_embedding.shape[1]
@@ -70,23 +71,23 @@ class NodeSelector(nn.Module):
             idx = torch.max(score, dim=-1)[1]  # batch_size List[int]
         # idx = torch.max(score, dim=-1)[1]
         prob = m.log_prob(idx)
-        # 确定这一跳的目的节点
-        idx = idx.tolist()
-        next_node = nodes[np.arange(len_step_i), [step_indices[i][idx[i]].item() for i in range(len_step_i)]]  # batch_size  np.ndarray[str]
+        # 确定这一跳的目的节点及其在 nodes 中的位置
+        next_idx = nn.utils.rnn.pad_sequence(step_indices, batch_first=True).gather(dim=1, index=idx.unsqueeze(-1)).squeeze(-1)  # [batch_size]
+        next_node = nodes[np.arange(len_step_i), next_idx.cpu().numpy()]  # batch_size  np.ndarray[str]
 
-        return next_node, activations, score, step_indices, prob
+        return next_node, next_idx, activations, score, step_indices, prob
 
     # @profile
     def walk_step(self, nodes, adj, label, all_node_embedding, input_info: torch.Tensor, agent_state: torch.Tensor,
-                  current_node: List[str], current_activation: torch.Tensor,
-                  current_score: torch.Tensor, train):
+                  current_idx: torch.Tensor, current_score: torch.Tensor, train):
 
-        node_idx = torch.as_tensor([[np.where(nodes[i]==current_node[i])[0][0]] for i in range(len(current_node))], dtype=torch.long, device=self.device)
+        # 当前节点在 nodes 中的位置由上一跳直接给出 [batch_size, 1]
+        node_idx = current_idx.unsqueeze(-1)
         node_state = all_node_embedding.gather(dim=1, index=node_idx.unsqueeze(-1).expand(-1, -1, all_node_embedding.size(-1))).squeeze()
 
         inp = torch.stack([input_info, agent_state, node_state], dim=1)
         state = self.modality_attention_layer(inp)
-        next_node, activations, score, step_indices, prob = self.node_score(all_node_embedding, state, node_idx, nodes, adj, train)
+        next_node, next_idx, activations, score, step_indices, prob = self.node_score(all_node_embedding, state, node_idx, nodes, adj, train)
 
         step_label = torch.zeros(label.shape, device=self.device)
         for i in range(step_label.shape[0]):
@@ -96,6 +97,7 @@ class NodeSelector(nn.Module):
         if torch.sum(current_score) != 0:
             current_score = (1 - self.propagation_rate) * current_score * torch.sum(current_score!=0, dim=1).unsqueeze(-1)
             score = self.propagation_rate * score * torch.sum(score!=0, dim=1).unsqueeze(-1)
+        # 首跳时 current_score 是模型复用、已清零的缓冲区，直接在其上原地累加
         for i in range(current_score.shape[0]):
             current_score[i].scatter_add_(0, step_indices[i], score[i][:len(step_indices[i])])
         current_score = current_score / current_score.sum(dim=1, keepdim=True)
@@ -104,4 +106,4 @@ class NodeSelector(nn.Module):
 
         nll = torch.sum(bi_tempered_logistic_loss(activations=activations, labels=step_label, t1=0.8, t2=1.2))
 
-        return state, next_node, current_activation, current_score, prob, nll
\ No newline at end of file
+        return state, next_node, next_idx, current_score, prob, nll
\ No newline at end of file
@@ -1,13 +1,12 @@
 import torch
 import lightning.pytorch as pl
 import numpy as np
-from typing import List, Union
 
 from KnowledgeSelection.Model.module import Environment, InputLayer
 from KnowledgeSelection.Model.GATv2 import GATv2
 from KnowledgeSelection.Model.Node import NodeSelector
 from KnowledgeSelection.Model.Knowledge import KnowledgeSelector
-from KnowledgeSelection.Model.model_utils import loss_function, reward_function
+from KnowledgeSelection.Model.model_utils import loss_function, reward_function, topk_accuracy
 
 
 class KnowledgeSelectionModel(pl.LightningModule):
@@ -35,72 +34,144 @@ class KnowledgeSelectionModel(pl.LightningModule):
         self.environment = Environment(opt)
 
         self.inputlayer = InputLayer(in_features=opt["hidden_dim"], out_features=int(opt["hidden_dim"] / 2))
-        self.gvt = GATv2(in_dim=opt["hidden_dim"], hidden_dim=int(opt["hidden_dim"] / 2), out_dim=1, num_heads=8, mask=self.mask)
+        self.gvt = GATv2(in_dim=opt["hidden_dim"], hidden_dim=int(opt["hidden_dim"] / 2), out_dim=1, num_heads=8,
+                         mask=torch.tensor(self.mask, dtype=torch.float16 if self.precision == "16" else torch.float32))
+        compile_mode = opt.get("compile", False)
+        # 这两种模式会用 CUDA Graph 重放，输出所在的存储在下一次调用时被覆盖
+        self.cudagraphs = compile_mode in ("reduce-overhead", "max-autotune")
+        if compile_mode:
+            # 原地编译，state_dict 的键不变；gvt 同时被 node_selector 共享。
+            # node/knowledge selector 以 numpy 与字符串处理为主，图中断过多，保持 eager
+            self.inputlayer.compile(mode=compile_mode, dynamic=True)
+            self.gvt.compile(mode=compile_mode, dynamic=True)
         self.node_selector = NodeSelector(opt["hidden_dim"], self.gvt, self.mask, opt["propagation_rate"])
         self.knowledge_selector = KnowledgeSelector(opt["hidden_dim"], self.base_poolsize, opt["min_poolsize"], self.environment, self.mask)
 
         self.samples = opt["samples"]
-        self.steps = int(1 + ((self.samples[0] / opt["rollouts"]) // self.batch_size))
-        self.optimizer = torch.optim.AdamW(self.parameters(), lr=opt["lr"], weight_decay=0.06, eps=1e-8)
-        self.scheduler = torch.optim.lr_scheduler.OneCycleLR(self.optimizer, max_lr=10 * opt["lr"], total_steps=opt["epochs"] * self.steps, pct_start=0.2, anneal_strategy="cos")
+        # 每 accum 个 batch 才更新一次参数；梯度直接累加在参数已有的 .grad 中，不额外占显存
+        self.steps = int(1 + ((self.samples[0] / opt["rollouts"] / opt.get("accum", 1)) // self.batch_size))
 
         self.training_step_outputs = []
         self.validation_step_outputs = []
 
-    def get_node_state(self, nodes: Union[List[str], np.ndarray]) -> torch.Tensor:
-        node_embedding = self.environment.get_knowledge_embedding(nodes)
-        node_state = torch.stack([d["avg_pool"] for d in node_embedding], dim=0)
+        # 跨 step 复用的状态与每一跳结果的缓冲区，节点维度按需扩容
+        max_batch = opt["rollouts"] * self.batch_size
+        self.register_buffer("_cur_score", torch.zeros(max_batch, 0), persistent=False)
+        self.register_buffer("_probs", torch.zeros(self.max_hops, max_batch), persistent=False)
+        self.register_buffer("_rewards", torch.zeros(self.max_hops, max_batch), persistent=False)
+        self.register_buffer("_node_nll", torch.zeros(self.max_hops), persistent=False)
+        self.register_buffer("_knowledge_nll", torch.zeros(self.max_hops), persistent=False)
+
+    def reuse_buffer(self, name, shape) -> torch.Tensor:
+        buffer = getattr(self, name)
+        if any(s > b for s, b in zip(shape, buffer.shape)):
+            # 验证阶段运行在 inference_mode 下，扩容若在其中发生会得到 inference tensor，
+            # 之后训练时对它原地清零或累加会报错，所以扩容总是在 inference_mode 之外分配
+            with torch.inference_mode(False):
+                buffer = torch.zeros([max(s, b) for s, b in zip(shape, buffer.shape)], dtype=buffer.dtype, device=buffer.device)
+            self.register_buffer(name, buffer, persistent=False)
+        # 切断上一 step 写入时留下的计算图，再原地清零复用
+        buffer.detach_()
+
+        return buffer[tuple(slice(0, s) for s in shape)].zero_()
+
+    def get_node_state(self, ids: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        # [B, max_len] -> [B, max_len, H]
+        node_state = self.environment.get_node_embedding(ids, mask)
 
         return node_state
 
     # @profile
     def forward(self, batch):
+        if self.cudagraphs:
+            # 推理时没有待执行的 backward，每次编译调用都会被当作新一轮而覆盖之前的输出，这里显式标记一个 batch 的开始
+            torch.compiler.cudagraph_mark_step_begin()
         inp = batch["embedding"]
         input_info = self.inputlayer(inp)
+        if self.cudagraphs:
+            # 在下一次编译调用覆盖之前拷贝出来，之后每一跳都会读取
+            input_info = input_info.clone()
         agent_state = input_info.clone()
 
-        current_node = batch["root"]
-        current_activation = torch.zeros(batch["nodes"].shape, dtype=torch.float, device=self.opt["device"])
-        current_score = torch.zeros(batch["nodes"].shape, dtype=torch.float, device=self.opt["device"])
-        all_node_embedding = torch.nn.utils.rnn.pad_sequence([self.get_node_state(n[n != ""]) for n in batch["nodes"]], batch_first=True)
+        # 经 Lightning 调用时 transfer_batch_to_device 已备好；直接调用 forward 时在这里取同一缓冲区
+        current_score = batch["_score"] if "_score" in batch else self.reuse_buffer("_cur_score", batch["nodes"].shape)
+        all_node_embedding = self.get_node_state(batch["node_ids"], batch["node_mask"])
         all_node_embedding = self.gvt(all_node_embedding, batch["adj"], glob=True)
-
-        result = []
+        if self.cudagraphs:
+            all_node_embedding = all_node_embedding.clone()
+
+        batch_size = len(batch["nodes"])
+        probs = self.reuse_buffer("_probs", (self.max_hops, batch_size))
+        rewards = self.reuse_buffer("_rewards", (self.max_hops, batch_size))
+        node_nlls = self.reuse_buffer("_node_nll", (self.max_hops,))
+        knowledge_nlls = self.reuse_buffer("_knowledge_nll", (self.max_hops,))
+        # 根节点在 nodes 中的位置只查一次，之后每一跳由 node_selector 直接给出
+        current_idx = torch.as_tensor([np.where(n == r)[0][0] for n, r in zip(batch["nodes"], batch["root"])],
+                                      dtype=torch.long, device=current_score.device)
+        visited, pools = [], []
+        num_steps = 0
         for step in range(0, self.max_hops):
-            agent_state, current_node, current_activation, current_score, prob, node_nll = self.node_selector(
+            agent_state, current_node, current_idx, current_score, prob, node_nll = self.node_selector(
                 (batch["nodes"], batch["adj"], batch["label"]), all_node_embedding, input_info, agent_state,
-                (current_node, current_activation, current_score), self.training, self.label_smoothing_rate)
-
-            knowledge_pool, knowledge_nll, raw_kp, mean_k = self.knowledge_selector((batch["gold_k"], batch["nodes"]),
-                                                                                    agent_state, current_score, self.label_smoothing_rate)
+                (current_idx, current_score), self.training, self.label_smoothing_rate)
 
-            current_reward, topk_acc, reward_detail = reward_function(self.node_reward, self.knowledge_reward, self.pool_reward, self.base_poolsize,
-                                                                      batch["gold_k"], batch["gold_n"], current_node, knowledge_pool, raw_kp)
+            knowledge_pool, pool_length, knowledge_nll, raw_kp, mean_k = self.knowledge_selector((batch["gold_k"], batch["nodes"]),
+                                                                                                 agent_state, current_score, self.label_smoothing_rate)
 
-            result.append((prob, current_reward, node_nll, knowledge_nll))
+            visited.append(current_node)
+            pools.extend(knowledge_pool)
+            probs[step].copy_(prob)
+            node_nlls[step].copy_(node_nll)
+            knowledge_nlls[step].copy_(knowledge_nll)
+            num_steps = step + 1
+            # 已写入缓冲区，尽早释放本跳的引用，不让它们留到下一跳重新绑定名字时才回收
+            del prob, node_nll, knowledge_nll
 
             if self.early_stop:
                 if mean_k < self.avg_pool_size:
                     break
 
-        pool_size = sum([len(kp) for kp in knowledge_pool])
-        reward = torch.sum(current_reward)
+        # 奖励不参与跳间的状态更新，所有跳合并为一次调用 [num_steps * B]
+        step_reward, reward_detail = reward_function(self.node_reward, self.knowledge_reward, self.pool_reward, self.base_poolsize,
+                                                     batch["gold_k"] * num_steps, batch["gold_n"], np.concatenate(visited), pools)
+        rewards[:num_steps].copy_(step_reward.view(num_steps, batch_size))
+        reward_detail = reward_detail[:, -batch_size:]
+        topk_acc = topk_accuracy(batch["gold_k"], raw_kp)
+        del visited, pools, step_reward, all_node_embedding
+
+        result = (probs[:num_steps], rewards[:num_steps], node_nlls[:num_steps], knowledge_nlls[:num_steps])
+        pool_size = pool_length.sum()
+        reward = torch.sum(rewards[num_steps - 1])
 
         if not self.training:
             self.avg_pool_size = pool_size / len(knowledge_pool)
 
         return result, topk_acc, pool_size, reward, reward_detail, knowledge_pool, raw_kp
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # batch 在 CPU 上组装并放入锁页内存，这里异步拷到 GPU；字符串与 numpy 字段留在 CPU
+        batch = {k: v.to(device, non_blocking=True) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+        # 首跳的节点分数取自复用的缓冲区，每个 batch 只清零一次，node_selector 在其上原地累加；之后各跳的分数仍是新张量。
+        # 验证时本 hook 在 inference_mode 下调用，reuse_buffer 的扩容会在其外分配
+        batch["_score"] = self.reuse_buffer("_cur_score", batch["nodes"].shape)
+
+        return batch
+
     def configure_optimizers(self):
+        # fused 要求参数已在 GPU 上，所以在 Lightning 把模型移到设备之后才创建优化器
+        fused = {"fused": True} if self.device.type == "cuda" else {"foreach": True}
+        self.optimizer = torch.optim.AdamW(self.parameters(), lr=self.opt["lr"], weight_decay=0.06, eps=1e-8, **fused)
+        self.scheduler = torch.optim.lr_scheduler.OneCycleLR(self.optimizer, max_lr=10 * self.opt["lr"], total_steps=self.opt["epochs"] * self.steps, pct_start=0.2, anneal_strategy="cos")
         return [self.optimizer], [self.scheduler]
 
     def training_step(self, batch, batch_idx):
-        result, topk_acc, avg_pool_size, reward, reward_detail, knowledge_pool, raw_kp = self.forward(batch)
+        result, topk_acc, avg_pool_size, reward, reward_detail, _, _ = self.forward(batch)
         loss, loss_detail = loss_function(result)
         num_steps = len(loss)
-        loss = sum(loss) / num_steps
+        loss = loss.mean()
         loss_detail = loss_detail / num_steps
-        self.log("Train Loss", loss, on_step=False, on_epoch=True, logger=True, batch_size=self.batch_size)
+        # 每个 step 都交给 Lightning，由其按 log_every_n_steps 决定何时写出；不做跨卡同步，epoch 级的 loss 由 log_outputs 汇总
+        self.log("Train Step Loss", loss, on_step=True, on_epoch=False, sync_dist=False, logger=True, batch_size=self.batch_size)
         self.training_step_outputs.append((topk_acc, avg_pool_size, reward, reward_detail, loss_detail, num_steps))
 
         return loss
@@ -110,50 +181,47 @@ class KnowledgeSelectionModel(pl.LightningModule):
         self.training_step_outputs.clear()  # free memory
 
     def validation_step(self, batch, batch_idx, dataloader_idx=0):
-        result, topk_acc, avg_pool_size, reward, reward_detail, knowledge_pool, raw_kp = self.forward(batch)
+        result, topk_acc, avg_pool_size, reward, reward_detail, _, _ = self.forward(batch)
         loss, loss_detail = loss_function(result)
         num_steps = len(loss)
-        loss = sum(loss) / num_steps
+        loss = loss.mean()
         loss_detail = loss_detail / num_steps
-        self.log("Val Loss", loss, on_step=False, on_epoch=True, logger=True, batch_size=self.batch_size)
         self.validation_step_outputs.append({dataloader_idx: (topk_acc, avg_pool_size, reward, reward_detail, loss_detail, num_steps)})
 
         return loss
 
     def on_validation_epoch_end(self):
-        idx_list = [list(i.keys())[0] for i in self.validation_step_outputs]
         if len(self.samples) == 5:
-            idx = [sum([i == 0 for i in idx_list]), sum([i == 1 for i in idx_list]), sum([i == 2 for i in idx_list]), sum([i == 3 for i in idx_list])]
-            idx = [sum(idx[0:i + 1]) for i in range(len(idx))]
-            self.log_outputs([list(i.values())[0] for i in self.validation_step_outputs[0:idx[0]]], "Val_Seen", num=self.samples[1])
-            self.log_outputs([list(i.values())[0] for i in self.validation_step_outputs[idx[0]:idx[1]]], "Val_UnSeen", num=self.samples[2])
-            self.log_outputs([list(i.values())[0] for i in self.validation_step_outputs[idx[1]:idx[2]]], "Test_Seen", num=self.samples[3])
-            self.log_outputs([list(i.values())[0] for i in self.validation_step_outputs[idx[2]:idx[3]]], "Test_UnSeen", num=self.samples[4])
+            splits = ["Val_Seen", "Val_UnSeen", "Test_Seen", "Test_UnSeen"]
         else:
-            idx = [sum([i == 0 for i in idx_list]), sum([i == 1 for i in idx_list])]
-            idx = [sum(idx[0:i + 1]) for i in range(len(idx))]
-            self.log_outputs([list(i.values())[0] for i in self.validation_step_outputs[0:idx[0]]], "Val", num=self.samples[1])
-            self.log_outputs([list(i.values())[0] for i in self.validation_step_outputs[idx[0]:idx[1]]], "Test", num=self.samples[2])
+            splits = ["Val", "Test"]
+        # 各 dataloader 的输出按顺序排列，用计数的前缀和得到每个划分的边界
+        idx_list = np.fromiter((next(iter(i)) for i in self.validation_step_outputs), dtype=np.int32, count=len(self.validation_step_outputs))
+        values = [next(iter(i.values())) for i in self.validation_step_outputs]
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(idx_list, minlength=len(splits)))))
+        for k, split in enumerate(splits):
+            self.log_outputs(values[bounds[k]:bounds[k + 1]], split, num=self.samples[k + 1])
         self.validation_step_outputs.clear()  # free memory
 
     def log_outputs(self, step_outputs, split, num):
-        loss_detail = np.zeros(3, dtype=float)
-        reward_detail = np.zeros(3, dtype=float)
-        acc = np.zeros(4, dtype=float)
-        avg_pool_size = 0
-        avg_steps = 0
-        reward = 0
-        cnt = 0
-        for output in step_outputs:
-            topk_acc, pool_size, batch_reward, batch_reward_detail, batch_loss_detail, num_steps = output
-            loss_detail += np.sum(batch_loss_detail, axis=0)
-            reward_detail += np.mean(batch_reward_detail, axis=1)
-            avg_steps += num_steps
-
-            acc += topk_acc
-            avg_pool_size += pool_size
-            reward += batch_reward
-            cnt += 1
+        cnt = len(step_outputs)
+        if cnt == 0:
+            # 划分没有任何 batch（size 截断、limit_val_batches 等），按全零统计，除以 cnt 后记为 NaN
+            stats = np.zeros(8, dtype=float)
+            avg_steps = np.float64(0)
+            acc = np.zeros(4, dtype=float)
+        else:
+            topk_acc, pool_size, batch_reward, batch_reward_detail, batch_loss_detail, num_steps = zip(*step_outputs)
+            # 各 batch 的统计量一直留在 GPU 上，这里归约后一次性拷回 CPU；
+            # 每个 batch 的跳数因 early stop 而不同，loss 按跳拼接后求和
+            stats = torch.cat([torch.cat(batch_loss_detail).sum(dim=0),
+                               torch.stack([d.mean(dim=1) for d in batch_reward_detail]).sum(dim=0),
+                               torch.stack(pool_size).sum().float().view(1),
+                               torch.stack(batch_reward).sum().view(1)]).cpu().numpy()
+            avg_steps = np.fromiter(num_steps, dtype=float).sum()
+            # top-k 命中在 CPU 上按字符串统计，本就是 numpy
+            acc = np.stack(topk_acc).sum(axis=0)
+        loss_detail, reward_detail, avg_pool_size, reward = stats[0:3], stats[3:6], stats[6], stats[7]
         if num > 0:
             loss_detail /= cnt
             reward_detail /= cnt
@@ -165,12 +233,13 @@ class KnowledgeSelectionModel(pl.LightningModule):
 
         if self.training:
             self.avg_pool_size = avg_pool_size
-        self.log("{} reward".format(split), reward, on_epoch=True, logger=True)
-        self.log("{} avg_pool_size".format(split), avg_pool_size, on_epoch=True, logger=True)
-        self.log("{} avg_steps".format(split), avg_steps, on_epoch=True, logger=True)
+        self.log("{} Loss".format(split), loss_detail.sum(), on_epoch=True, logger=True, sync_dist=True)
+        self.log("{} reward".format(split), reward, on_epoch=True, logger=True, sync_dist=True)
+        self.log("{} avg_pool_size".format(split), avg_pool_size, on_epoch=True, logger=True, sync_dist=True)
+        self.log("{} avg_steps".format(split), avg_steps, on_epoch=True, logger=True, sync_dist=True)
         for idx, k in enumerate(["1", "5", "10", "All"]):
-            self.log("{} top-{}".format(split, k), acc[idx], on_epoch=True, prog_bar=True, logger=True)
+            self.log("{} top-{}".format(split, k), acc[idx], on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
         for idx, name in enumerate(["Walk Loss", "Node Loss", "Knowledge Loss"]):
-            self.log("{} {}".format(split, name), loss_detail[idx], on_epoch=True, prog_bar=True, logger=True)
+            self.log("{} {}".format(split, name), loss_detail[idx], on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
         for idx, name in enumerate(["Node reward", "Knowledge reward", "Pool reward"]):
-            self.log("{} {}".format(split, name), reward_detail[idx], on_epoch=True, prog_bar=True, logger=True)
\ No newline at end of file
+            self.log("{} {}".format(split, name), reward_detail[idx], on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
\ No newline at end of file
@@ -13,36 +13,36 @@ def padding(inp:List[torch.Tensor], pad=0):
 
 
 def loss_function(result, rl=True):
-    # result: T * (prob:[batch_size], reward:[batch_size])
-    batch_size = result[0][0].shape[0]
-    loss = []
-    detail = []
-    reward = torch.zeros(batch_size, device="cuda:0")
+    # result: (prob:[T, batch_size], reward:[T, batch_size], node_nll:[T], knowledge_nll:[T])
     if rl:
+        prob, step_reward, node_nll, knowledge_nll = result
+        num_steps, batch_size = prob.shape
         gamma = 0.98
-        for l in result[::-1]:
-            prob, step_reward, node_nll, knowledge_nll = l
-
-            reward = step_reward + gamma * reward
-            walk_loss = 0.25*torch.sum(-prob * (reward+3)) / batch_size
-            # node_nll = torch.sum(torch.exp(prob) * node_nll)/ self.batch_size
-            node_nll = 0.75*node_nll / batch_size
-            # knowledge_nll = torch.sum(torch.exp(prob) * knowledge_nll)/ self.batch_size
-            knowledge_nll = 1.5*knowledge_nll / batch_size
-            loss.append(walk_loss + node_nll + knowledge_nll)  # T
-            detail.append([walk_loss.item(), node_nll.item(), knowledge_nll.item()])  # T,3
+        # 折扣回报 R_t = sum_{k>=t} gamma^(k-t) * r_k，用上三角折扣矩阵一次算出所有跳 [T, batch_size]
+        power = torch.arange(num_steps, device=prob.device)
+        discount = torch.triu(gamma ** (power.unsqueeze(0) - power.unsqueeze(1)).float())
+        reward = discount @ step_reward
+
+        walk_loss = 0.25*torch.sum(-prob * (reward+3), dim=-1) / batch_size
+        # node_nll = torch.sum(torch.exp(prob) * node_nll)/ self.batch_size
+        node_nll = 0.75*node_nll / batch_size
+        # knowledge_nll = torch.sum(torch.exp(prob) * knowledge_nll)/ self.batch_size
+        knowledge_nll = 1.5*knowledge_nll / batch_size
+        loss = walk_loss + node_nll + knowledge_nll  # T
+        detail = torch.stack([walk_loss, node_nll, knowledge_nll], dim=-1)  # T,3
 
     else:
-        for l in result[::-1]:
-            step_reward, node_nll, knowledge_nll = l
-            # node_nll = torch.sum(torch.exp(prob) * node_nll)/ self.batch_size
-            node_nll = node_nll / batch_size
-            # knowledge_nll = torch.sum(torch.exp(prob) * knowledge_nll)/ self.batch_size
-            knowledge_nll = knowledge_nll / batch_size
-            loss.append(node_nll + knowledge_nll)  # T
-            detail.append([node_nll.item(), knowledge_nll.item()])  # T,3
+        step_reward, node_nll, knowledge_nll = result
+        batch_size = step_reward.shape[1]
+        # node_nll = torch.sum(torch.exp(prob) * node_nll)/ self.batch_size
+        node_nll = node_nll / batch_size
+        # knowledge_nll = torch.sum(torch.exp(prob) * knowledge_nll)/ self.batch_size
+        knowledge_nll = knowledge_nll / batch_size
+        loss = node_nll + knowledge_nll  # T
+        detail = torch.stack([node_nll, knowledge_nll], dim=-1)  # T,2
 
-    return loss, np.array(detail)
+    # detail 留在 GPU 上，由调用方一次性拷回，避免每一跳 .item() 同步
+    return loss, detail.detach()
 
 
 def topk_accuracy(label:List[List[str]], output:List[List[str]]):
@@ -64,26 +64,24 @@ def topk_accuracy(label:List[List[str]], output:List[List[str]]):
     return topk_recall
 
 
-def reward_function(node_reward_base, knowledge_reward_base, pool_reward_base, base_poolsize, gold_k:List[List[str]], gold_n:List[str], nodes:List[str], pool:List[List[str]], raw_pool:List[List[str]]):
+def reward_function(node_reward_base, knowledge_reward_base, pool_reward_base, base_poolsize, gold_k:List[List[str]], gold_n:List[str], nodes:List[str], pool:List[List[str]]):
     batch_size = len(gold_k)
     node_reward = np.zeros(batch_size, dtype=float)
     knowledge_reward = np.zeros(batch_size, dtype=float)
     pool_reward = np.zeros(batch_size, dtype=float)
-    reward = torch.zeros(batch_size, device="cuda:0")
+    node_reward[:] = np.where(np.isin(nodes, gold_n), 2*node_reward_base, -node_reward_base)
     for i in range(batch_size):
-        node_reward[i] = 2*node_reward_base if nodes[i] in gold_n else -node_reward_base
-
         gold_knowledge = np.array([2.0-0.1*(pool[i].index(g)) if g in pool[i] else -1 for g in gold_k[i]])
         locate = np.max(np.mean(gold_knowledge),-1)
         knowledge_reward[i] = knowledge_reward_base * locate
 
         pool_reward[i] = pool_reward_base * (locate/32) / (len(pool[i])/base_poolsize)
 
-        reward[i] = node_reward[i]+knowledge_reward[i]+pool_reward[i]
-
-    topk_acc = topk_accuracy(gold_k, raw_pool)
+    # 字符串匹配只能在 CPU 上做，结果一次性拷到 GPU，而不是逐元素写入 GPU 张量
+    detail = torch.as_tensor(np.array([node_reward, knowledge_reward, pool_reward]), dtype=torch.float, device="cuda:0")
+    reward = detail.sum(dim=0)
 
-    return reward, topk_acc, np.array([node_reward, knowledge_reward, pool_reward])
+    return reward, detail
 
 
 def smooth_labels(input, smoothing_rate):
@@ -3,14 +3,33 @@ import torch
 from typing import List, Union
 import torch.nn as nn
 import torch.nn.functional as F
-from utils import read_json, absolute_path
+from utils import read_json, absolute_path, node_index
 
 
 class Environment:
     def __init__(self, opt):
         path_prefix = f"Data/{opt['data_name']}/Preprocess/Intermediate/"
         self.knowledge_base = read_json(absolute_path(path_prefix + "knowledge_base.json"))
-        self.knowledge_embedding = torch.load(absolute_path(path_prefix+"knowledge_embedding.pth"), map_location=opt["device"])
+        knowledge_embedding = torch.load(absolute_path(path_prefix+"knowledge_embedding.pth"), map_location=opt["device"])
+
+        # 按 node_index 的编号排列成稠密表，第 0 行为填充节点 ""（全零向量、无知识）
+        self.node2idx = node_index(self.knowledge_base)
+        avg_pool = [torch.zeros(opt["hidden_dim"], device=opt["device"])]
+        sentences = []
+        length = [0]
+        for node in self.knowledge_base:
+            embedding = knowledge_embedding.get(node)
+            if embedding is None:
+                avg_pool.append(avg_pool[0])
+                length.append(0)
+            else:
+                avg_pool.append(embedding["avg_pool"])
+                sentences.append(embedding["embedding"])
+                length.append(len(embedding["embedding"]))
+        self.avg_pool_table = torch.stack(avg_pool, dim=0)  # [num_nodes + 1, H]
+        # 所有节点的知识句向量首尾相接，节点 i 的句子位于 [offset[i], offset[i + 1])
+        self.knowledge_table = torch.cat(sentences, dim=0)  # [num_sentences, H]
+        self.knowledge_offset = np.concatenate([[0], np.cumsum(length)])
 
     def get_knowledge_text(self, entity: Union[List[str], np.ndarray]) -> List[List[str]]:
         text = []
@@ -18,11 +37,28 @@ class Environment:
             text.append(self.knowledge_base[e])
         return text
 
-    def get_knowledge_embedding(self, entity: Union[List[str], np.ndarray]) -> np.ndarray:
-        embedding = []
-        for e in entity:
-            embedding.append(self.knowledge_embedding[e])
-        return np.array(embedding)
+    def get_knowledge_embedding(self, entity: Union[List[str], np.ndarray]) -> torch.Tensor:
+        """
+        按顺序取出若干节点的全部知识句向量并拼接
+        :return: [sum(len(knowledge_base[e])), H]
+        """
+        ids = np.fromiter((self.node2idx[e] for e in entity), dtype=np.int64, count=len(entity))
+        start = self.knowledge_offset[ids]
+        length = self.knowledge_offset[ids + 1] - start
+        rows = np.repeat(start - np.cumsum(length) + length, length) + np.arange(length.sum())
+
+        return self.knowledge_table.index_select(dim=0, index=torch.as_tensor(rows, device=self.knowledge_table.device))
+
+    def get_node_embedding(self, ids: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        一次查表取出整个 batch 的节点 avg_pool 向量
+        :param ids: [B, max_len] 的节点编号（node_index），0 为填充
+        :param mask: [B, max_len] 的有效节点掩码
+        :return: [B, max_len, H]，填充位置为全零
+        """
+        node_embedding = self.avg_pool_table.index_select(dim=0, index=ids.flatten()).view(*ids.shape, -1)
+
+        return node_embedding * mask.unsqueeze(-1)
 
 class ModalityAttentionLayer(nn.Module):
     def __init__(self, hidden_dim = 768):
@@ -2,7 +2,7 @@ import os
 import cProfile
 import torch
 import lightning.pytorch as pl
-from lightning.pytorch.callbacks import ModelCheckpoint
+from lightning.pytorch.callbacks import ModelCheckpoint, TQDMProgressBar
 from lightning.pytorch.loggers import CSVLogger
 import warnings
 
@@ -44,8 +44,10 @@ def gate_training(config):
 
     ks = KnowledgeSelectionModel(opt_model).to(device)
     # ks = torch.compile(ks)
-    trainer = pl.Trainer(accelerator='gpu', max_epochs=opt_model["epochs"], callbacks=[checkpoint_callback], logger=logger,
-                         precision=opt_model["precision"])
+    # 进度条每 50 个 batch 刷新一次，与默认的 log_every_n_steps 一致
+    progress_bar = TQDMProgressBar(refresh_rate=50)
+    trainer = pl.Trainer(accelerator='gpu', max_epochs=opt_model["epochs"], callbacks=[checkpoint_callback, progress_bar], logger=logger,
+                         precision=opt_model["precision"], accumulate_grad_batches=opt_model.get("accum", 1))
 
     trainer.fit(ks, train_dataloaders=loader_dict["train"],
                 val_dataloaders=[loader_dict["valid_seen"], loader_dict["valid_unseen"], loader_dict["test_seen"], loader_dict["test_unseen"]])
\ No newline at end of file
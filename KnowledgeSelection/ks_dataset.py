@@ -1,8 +1,8 @@
 from typing import List, Dict, TypedDict
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
-from utils import read_json, data_name_to_path, absolute_path
+from torch.utils.data import Dataset, DataLoader, Sampler
+from utils import read_json, data_name_to_path, absolute_path, node_index
 from functools import partial
 from tqdm import tqdm
 import numpy as np
@@ -35,17 +35,43 @@ class KSDataset(Dataset):
         return sample
 
 
+class BucketSampler(Sampler):
+    """
+    按子图节点数分桶的 batch sampler，减少 batch 内的 padding。
+    每个 epoch 先全局打乱，再在每 bucket_size 个 batch 的范围内按节点数排序切分，最后打乱 batch 的顺序。
+    """
+    def __init__(self, lengths, batch_size, bucket_size=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).numpy()
+        chunk = self.batch_size * self.bucket_size
+        batches = []
+        for i in range(0, len(indices), chunk):
+            bucket = indices[i:i + chunk]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[j:j + self.batch_size].tolist() for j in range(0, len(bucket), self.batch_size))
+        for idx in torch.randperm(len(batches)).tolist():
+            yield batches[idx]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
 class KSLoader:
     def __init__(self, opt):
         self.opt = opt
         self.data_path = data_name_to_path(opt["data_name"])
         self.loader_dict = {}
         self.loader_length = {}
+        self.node2idx = node_index(read_json(f"Data/{opt['data_name']}/Preprocess/Intermediate/knowledge_base.json"))
 
     def text_embedding_combine(self, json_path, embed_path):
         data = []
         text = read_json(json_path)["data"]
-        embedding = torch.load(absolute_path(embed_path), map_location=torch.device('cuda:0'))
+        embedding = torch.load(absolute_path(embed_path), map_location=torch.device('cpu'))
         assert len(text) == len(embedding)
 
         # Extract a portion of the data for procedure testing. size:(0,1]
@@ -83,13 +109,22 @@ class KSLoader:
 
         embedding = torch.stack(embedding, dim=0)  # tensor [B * 3 * H]
 
+        # 节点维补齐到 8 的倍数，fp16 下 GAT 的矩阵乘可走 Tensor Core；填充节点在 adj 中无边，注意力会被 mask 掉
         max_n = max([len(n) for n in nodes])
+        max_n = (max_n + 7) // 8 * 8
         padded_nodes = []
         for arr in nodes:
             padded_arr = np.pad(arr, (0, max_n - len(arr)), constant_values='')
             padded_nodes.append(np.char.array(padded_arr))
         nodes = np.vstack(padded_nodes)  # np.array [B * max_len]
 
+        # tensor [B * max_len]    节点编号与有效掩码，模型查 embedding 用；nodes 仍用于取知识文本与奖励
+        # 同一 batch 内节点大量重复，只对去重后的节点查一次字典，再按逆索引铺回；填充 "" 的编号为 0
+        unique_nodes, inverse = np.unique(nodes, return_inverse=True)
+        unique_ids = np.fromiter((self.node2idx[n] for n in unique_nodes), dtype=np.int64, count=len(unique_nodes))
+        node_ids = torch.as_tensor(unique_ids[inverse].reshape(nodes.shape), device=device)
+        node_mask = node_ids != 0
+
         # tensor [B * max_len * max_len]    max_len: nodes
         adj_matrix = torch.zeros((len(adj), max_n, max_n), dtype=torch.int, device=device)
 
@@ -98,6 +133,7 @@ class KSLoader:
 
         # tensor [B * max_len]    max_len: nodes
         label = nn.utils.rnn.pad_sequence(label, batch_first=True, padding_value=0)
+        label = nn.functional.pad(label, (0, max_n - label.shape[1]), value=0)
 
         keywords = np.array(keywords)
         utterance = np.array(utterance)
@@ -110,11 +146,13 @@ class KSLoader:
             keywords = np.tile(keywords, rollout)
             utterance = np.tile(utterance, rollout)
             nodes = np.tile(nodes, (rollout, 1))
+            node_ids = node_ids.repeat(rollout, 1)
+            node_mask = node_mask.repeat(rollout, 1)
             adj_matrix = adj_matrix.repeat(rollout, 1, 1)
             label = label.repeat(rollout, 1)
 
         return {"embedding": embedding, "gold_k": gold_k, "gold_n": gold_n, "root": root, "nodes": nodes,
-                "adj": adj_matrix, "label": label,
+                "node_ids": node_ids, "node_mask": node_mask, "adj": adj_matrix, "label": label,
                 "keywords": keywords, "utterance": utterance, "history": history, "response": response}
 
     def get_loader(self, topic_split=True, train=True):
@@ -130,12 +168,13 @@ class KSLoader:
             data = self.text_embedding_combine(json_path, embed_path)
             dataset = KSDataset(data)
             if "train" in json_path and train:
-                loader = DataLoader(dataset, batch_size=self.opt["batch_size"], shuffle=True,
-                                    collate_fn=partial(self.dialogue_collate, device='cuda:0', train=True,
+                sampler = BucketSampler([len(d["Nodes"]) for d in data], self.opt["batch_size"])
+                loader = DataLoader(dataset, batch_sampler=sampler, pin_memory=True,
+                                    collate_fn=partial(self.dialogue_collate, device='cpu', train=True,
                                                        rollout=self.opt["rollouts"]))
             else:
-                loader = DataLoader(dataset, batch_size=self.opt["rollouts"]*self.opt["batch_size"], shuffle=False,
-                                    collate_fn=partial(self.dialogue_collate, device='cuda:0', train=False))
+                loader = DataLoader(dataset, batch_size=self.opt["rollouts"]*self.opt["batch_size"], shuffle=False, pin_memory=True,
+                                    collate_fn=partial(self.dialogue_collate, device='cpu', train=False))
 
             # e.g. key = "test_unseen"
             key = json_path.split(".")[0].split("/")[-1]
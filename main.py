@@ -1,6 +1,17 @@
+import os
+
+# 每个 batch 的节点数不同，张量尺寸多变；必须在任何 CUDA 分配之前设置以减少显存碎片
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+import torch
 from KnowledgeSelection import Trainer
 from utils import read_json
 
+# Ampere 及以上的 GPU 上 fp32 矩阵乘走 TF32
+torch.set_float32_matmul_precision("high")
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 
 if __name__ == '__main__':
     data_name = "WoW"
@@ -251,6 +251,14 @@ def data_split_and_save(dataset, splits, filepaths):
         previous_split = current_split
 
 
+def node_index(knowledge_base):
+    """
+    节点名 -> 行号，第 0 行留给填充节点 ""
+    Environment 与 KSLoader 共用，保证两边的节点编号一致
+    """
+    return {node: idx for idx, node in enumerate([""] + list(knowledge_base))}
+
+
 def data_name_to_path(data_name):
     path_list = [f"Topic_split/{s}" for s in ["train", "valid_seen", "valid_unseen", "test_seen", "test_unseen"]]
     if data_name == "OpendialKG":